@@ -1,27 +1,120 @@
 #!/usr/bin/env python3
 """
-Tableau Workbook (.twb) Translator
+Tableau Workbook (.twb/.twbx) Translator
 Uses Claude API to translate user-facing text while preserving XML structure
 Supports translation to any language (default: English)
 """
 
+import io
+import asyncio
 import re
 import os
 import sys
+import string
+import shutil
+import sqlite3
+import hashlib
+import zipfile
+import tempfile
 import argparse
 import xml.etree.ElementTree as ET
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
-from anthropic import Anthropic
+from aiolimiter import AsyncLimiter
+from anthropic import AsyncAnthropic
 
 # Configuration
 INPUT_FILE = "Viljandimaa ÜTK.twb"
 TARGET_LANGUAGE = "English"  # Default target language
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")  # Set your API key as environment variable
+MODEL = "claude-sonnet-4-5-20250929"  # Used for descriptions (rich text)
+LABEL_MODEL = "claude-haiku-4-5-20251001"  # Cheaper, faster model for short labels and names
+MAX_TOKENS = 4000  # Upper bound on output tokens per translation request
+MIN_BATCH_API_ITEMS = 5  # Smaller runs are translated with direct API calls
+BATCH_POLL_INTERVAL = 20  # Seconds between Message Batches status checks
+MAX_CONCURRENT_REQUESTS = 8  # Direct API calls in flight at once
+REQUESTS_PER_MINUTE = 40  # Direct API call rate limit
+ZIP_MAGIC = b'PK\x03\x04'  # Packaged workbooks (.twbx) are zip archives
+WRITE_BUFFER_SIZE = 1 << 20  # Buffer size for writing the translated file
+CACHE_PATH = os.path.expanduser("~/.cache/tableau_translate.sqlite")  # Translations reused across runs
 
 if not ANTHROPIC_API_KEY:
     raise ValueError("Please set ANTHROPIC_API_KEY environment variable")
 
-client = Anthropic(api_key=ANTHROPIC_API_KEY)
+client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+
+# Instructions shared by every translation request
+TRANSLATION_RULES = """You translate user-facing text from Tableau workbooks.
+
+IMPORTANT RULES:
+1. Keep place names and company names as they are (e.g., "Viljandimaa", "Tartu", "TK", "ÜTK")
+2. Preserve Tableau technical terminology exactly as it should be in the target language
+3. Only translate the user-facing labels and descriptions
+4. Do NOT include any special characters that need XML escaping (use plain quotes, not &quot;)
+5. Return the translations with the emit_translations tool, one item per input text
+6. Set "i" to the number of the input text and "t" to its translation (plain text only)
+"""
+
+# Tool Claude is required to call, so translations come back as structured data
+TRANSLATION_TOOL = {
+    "name": "emit_translations",
+    "description": "Return the translation of every input text",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "i": {"type": "integer", "description": "Number of the input text"},
+                        "t": {"type": "string", "description": "Translated text"}
+                    },
+                    "required": ["i", "t"]
+                }
+            }
+        },
+        "required": ["items"]
+    }
+}
+
+# Start tags and run text, scanned once to find every text that may be substituted
+# Matched against the raw UTF-8 bytes (multi-byte characters never contain these ASCII delimiters)
+REPLACE_PATTERN = re.compile(
+    rb"(?P<run_prefix><run\b[^>]*>)\s*(?P<run_value>[^<]+?)\s*(?P<run_suffix></run>)"
+    rb"|<(?P<tag>[A-Za-z][\w:.-]*)(?P<attributes>[^>]*)>"
+)
+
+# Single-quoted attribute inside a start tag
+ATTRIBUTE_PATTERN = re.compile(rb"(?P<name>[\w:.-]+)='(?P<value>[^']+)'")
+
+# Elements whose name attribute refers to a worksheet or dashboard
+NAMED_TAGS = frozenset([b'worksheet', b'dashboard', b'zone', b'thumbnail', b'viewpoint'])
+
+# Technical field names (e.g. "number_of_records") are not translated
+TECH_NAME_CHARS = frozenset(string.ascii_lowercase + '_')
+
+# XML special characters and their entities, applied in a single pass
+XML_ESCAPE_TABLE = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    "'": '&apos;',
+    '"': '&quot;',
+})
+
+# The five predefined XML entities, decoded in a single pass (so "&amp;lt;" becomes "&lt;")
+XML_ENTITY_PATTERN = re.compile(r'&(amp|lt|gt|apos|quot);')
+XML_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'apos': "'", 'quot': '"'}
+
+# Whitespace normalisation applied by the XML parser: line ends in text become "\n",
+# and line ends and tabs in attribute values become spaces
+LINE_END_PATTERN = re.compile(r'\r\n?')
+ATTRIBUTE_WHITESPACE_PATTERN = re.compile(r'\r\n|[\r\n\t]')
+
+# Categories whose texts are skipped when they contain "&" (worksheet and dashboard names are not)
+AMPERSAND_FILTERED_TYPES = frozenset(['captions', 'aliases', 'descriptions', 'members'])
 
 
 def get_language_code(language):
@@ -50,29 +143,207 @@ def get_language_code(language):
 def create_backup(file_path):
     """Create a backup of the original file"""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_path = file_path.replace('.twb', f'_backup_{timestamp}.twb')
-
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    base_path, extension = os.path.splitext(file_path)
+    backup_path = f"{base_path}_backup_{timestamp}{extension}"
 
-    with open(backup_path, 'w', encoding='utf-8') as f:
-        f.write(content)
+    # Let the OS copy the file (and its metadata) without reading it into Python
+    shutil.copy2(file_path, backup_path)
 
     print(f"✓ Backup created: {os.path.basename(backup_path)}")
     return backup_path
 
 
-def validate_xml(content):
-    """Validate that the content is well-formed XML"""
+def is_packaged_workbook(path):
+    """Check whether the file is a packaged workbook (.twbx zip) rather than plain .twb XML"""
+    with open(path, 'rb') as f:
+        return f.read(4) == ZIP_MAGIC
+
+
+def find_twb_member(package):
+    """Name of the workbook XML inside a packaged workbook"""
+    for name in package.namelist():
+        if name.endswith('.twb') and '/' not in name:
+            return name
+    raise ValueError(f"No .twb workbook found in {package.filename}")
+
+
+@contextmanager
+def open_workbook_xml(path):
+    """Open the workbook XML for binary reading, from a .twb file or inside a .twbx package"""
+    if not is_packaged_workbook(path):
+        with open(path, 'rb') as f:
+            yield f
+        return
+
+    with zipfile.ZipFile(path) as package, package.open(find_twb_member(package)) as f:
+        yield f
+
+
+@contextmanager
+def create_workbook_xml(output_path, input_path):
+    """
+    Open the translated workbook XML for binary writing
+    For a .twbx package, every other file (extracts, images) is streamed over unchanged
+    The package is built in a temporary file and moved into place at the end, so the
+    source is never truncated while being read (e.g. when output_path is the input)
+    """
+    if not is_packaged_workbook(input_path):
+        with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            yield f
+        return
+
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(output_path)))
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(input_path) as source, \
+                zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as package:
+            twb_member = find_twb_member(source)
+            for info in source.infolist():
+                if info.filename == twb_member:
+                    continue
+                if info.is_dir():
+                    package.writestr(info, b'')
+                    continue
+                with source.open(info) as src, package.open(info, 'w') as dst:
+                    shutil.copyfileobj(src, dst, WRITE_BUFFER_SIZE)
+
+            with package.open(twb_member, 'w') as f:
+                yield f
+        # mkstemp creates the file private; give it the input's permissions
+        shutil.copymode(input_path, temp_path)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def open_translation_cache(path=CACHE_PATH):
+    """Open (and create if needed) the on-disk translation cache"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS translations (
+            text_hash TEXT NOT NULL,
+            target_language TEXT NOT NULL,
+            model TEXT NOT NULL,
+            translation TEXT NOT NULL,
+            PRIMARY KEY (text_hash, target_language, model)
+        )
+    """)
+    return conn
+
+
+def text_hash(text):
+    """Cache key for a source text"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def get_cached_translations(conn, text_items, target_language, model=MODEL):
+    """
+    Look up previously stored translations
+    Returns a dictionary mapping original text to translated text for the cache hits
+    """
+    translations = {}
+    for text in text_items:
+        row = conn.execute(
+            "SELECT translation FROM translations WHERE text_hash = ? AND target_language = ? AND model = ?",
+            (text_hash(text), target_language.lower(), model)
+        ).fetchone()
+        if row:
+            translations[text] = row[0]
+    return translations
+
+
+def store_translations(conn, translations, target_language, model=MODEL):
+    """Store new translations in the cache in a single transaction"""
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO translations (text_hash, target_language, model, translation) VALUES (?, ?, ?, ?)",
+            [(text_hash(text), target_language.lower(), model, translated)
+             for text, translated in translations.items()]
+        )
+
+
+def validate_xml(source):
+    """Validate that the file (path or file object) is well-formed XML"""
     try:
-        # Try to parse the XML
-        ET.fromstring(content)
+        # Stream through the XML, discarding elements as they are parsed
+        for _, elem in ET.iterparse(source):
+            elem.clear()
         return True, "XML is well-formed"
     except ET.ParseError as e:
         return False, f"XML parse error: {e}"
 
 
-def translate_with_claude(text_items, target_language="English", context=""):
+def estimate_max_tokens(text_items):
+    """
+    Output token ceiling for translating text_items with the emit_translations tool
+    Allows roughly one token per two characters of translated text, about 24 tokens per
+    item for its JSON object ({"i": 12, "t": "..."} is ~12 tokens, doubled for escaping
+    and longer translations) and 128 for the tool call and {"items": [...]} wrapper
+    """
+    return min(MAX_TOKENS, 128 + sum(len(text) // 2 + 24 for text in text_items))
+
+
+def build_translation_request(text_items, target_language="English", context="", model=MODEL):
+    """
+    Build the Messages API parameters for translating a list of text items
+    Shared by direct calls and Message Batches requests
+    """
+    # Only the texts and target language vary between calls; the rules are a fixed system block.
+    # cache_control has no effect at the current size: tools + rules are a few hundred tokens,
+    # below the minimum cacheable prompt length of the Sonnet and Haiku models used here
+    prompt = f"""Translate the following texts to {target_language}.
+
+Context: {context}
+
+Texts to translate:
+{chr(10).join(f"{i+1}. {text}" for i, text in enumerate(text_items))}
+"""
+
+    return {
+        "model": model,
+        "max_tokens": estimate_max_tokens(text_items),
+        "tools": [TRANSLATION_TOOL],
+        "tool_choice": {"type": "tool", "name": TRANSLATION_TOOL["name"]},
+        "system": [{
+            "type": "text",
+            "text": TRANSLATION_RULES,
+            "cache_control": {"type": "ephemeral"}
+        }],
+        "messages": [{
+            "role": "user",
+            "content": prompt
+        }]
+    }
+
+
+def parse_translations(response, text_items):
+    """
+    Parse a Claude response into a dictionary mapping original text to translated text
+    The tool input is not guaranteed to follow the schema (e.g. it is {} when the
+    response hit max_tokens), so malformed items are skipped
+    """
+    tool_input = next((block.input for block in response.content if block.type == "tool_use"), {})
+    items = tool_input.get("items", []) if isinstance(tool_input, dict) else []
+    translations = {}
+
+    # Map each item's number back to the input text
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        index, translated = item.get("i"), item.get("t")
+        if not isinstance(index, int) or isinstance(index, bool) or not isinstance(translated, str):
+            continue
+        if 0 <= index - 1 < len(text_items) and translated.strip():
+            translations[text_items[index - 1]] = translated.strip()
+
+    return translations
+
+
+async def translate_with_claude(text_items, target_language="English", context="", model=MODEL):
     """
     Translate a list of text items to target language using Claude API
     Returns a dictionary mapping original text to translated text
@@ -80,211 +351,311 @@ def translate_with_claude(text_items, target_language="English", context=""):
     if not text_items:
         return {}
 
-    # Create prompt for Claude
-    prompt = f"""Translate the following texts to {target_language}.
+    try:
+        response = await client.messages.create(**build_translation_request(text_items, target_language, context, model))
+        return parse_translations(response, text_items)
 
-IMPORTANT RULES:
-1. Keep place names and company names as they are (e.g., "Viljandimaa", "Tartu", "TK", "ÜTK")
-2. Preserve Tableau technical terminology exactly as it should be in {target_language}
-3. Only translate the user-facing labels and descriptions
-4. Do NOT include any special characters that need XML escaping (use plain quotes, not &quot;)
-5. Return ONLY a numbered list with translations, one per line
-6. Keep the same order as the input
+    except Exception as e:
+        print(f"Error translating batch: {e}")
+        return {}
 
-Context: {context}
 
-Texts to translate:
-{chr(10).join(f"{i+1}. {text}" for i, text in enumerate(text_items))}
+async def translate_concurrently(batches, target_language="English"):
+    """
+    Translate batches with direct API calls running concurrently
+    Concurrency and request rate are capped to stay within API rate limits
+    batches is a list of (custom_id, text_items, context, model) tuples
+    Returns a dictionary mapping original text to translated text
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = AsyncLimiter(REQUESTS_PER_MINUTE, 60)
 
-Return format (plain text only, no special XML characters):
-1. [translation of first item]
-2. [translation of second item]
-etc.
-"""
+    async def translate_batch(custom_id, text_items, context, model):
+        async with semaphore, limiter:
+            translations = await translate_with_claude(text_items, target_language=target_language,
+                                                       context=context, model=model)
+
+        print(f"  Batch {custom_id}: {len(text_items)} items")
+
+        # Show some examples
+        for orig, trans in list(translations.items())[:3]:
+            print(f"    '{orig}' → '{trans}'")
+
+        return translations
+
+    results = await asyncio.gather(*(translate_batch(*batch) for batch in batches))
+
+    all_translations = {}
+    for translations in results:
+        all_translations.update(translations)
+    return all_translations
+
+
+async def translate_with_batch_api(batches, target_language="English"):
+    """
+    Translate all batches in one Message Batches API job (50% cheaper than direct calls)
+    batches is a list of (custom_id, text_items, context, model) tuples
+    Returns a dictionary mapping original text to translated text
+    """
+    if not batches:
+        return {}
+
+    items_by_id = {custom_id: text_items for custom_id, text_items, _, _ in batches}
+    translations = {}
 
     try:
-        response = client.messages.create(
-            model="claude-sonnet-4-5-20250929",
-            max_tokens=4000,
-            messages=[{
-                "role": "user",
-                "content": prompt
-            }]
-        )
+        message_batch = await client.messages.batches.create(requests=[
+            {
+                "custom_id": custom_id,
+                "params": build_translation_request(text_items, target_language, context, model)
+            }
+            for custom_id, text_items, context, model in batches
+        ])
+        print(f"  Submitted message batch {message_batch.id} ({len(batches)} requests)")
+
+        # Poll until every request in the batch has been processed
+        while message_batch.processing_status != "ended":
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            message_batch = await client.messages.batches.retrieve(message_batch.id)
+            counts = message_batch.request_counts
+            print(f"  Waiting for batch: {counts.processing} processing, "
+                  f"{counts.succeeded} succeeded, {counts.errored} errored")
+
+        async for entry in await client.messages.batches.results(message_batch.id):
+            if entry.result.type != "succeeded":
+                print(f"Error translating batch {entry.custom_id}: {entry.result.type}")
+                continue
+
+            # One bad entry must not discard the results of the others
+            try:
+                batch_translations = parse_translations(entry.result.message, items_by_id[entry.custom_id])
+            except Exception as e:
+                print(f"Error parsing batch {entry.custom_id}: {e}")
+                continue
+            translations.update(batch_translations)
 
-        # Parse response
-        response_text = response.content[0].text
-        translations = {}
-
-        # Extract translations from numbered list
-        lines = response_text.strip().split('\n')
-        for i, line in enumerate(lines):
-            # Remove numbering (e.g., "1. ", "2. ", etc.)
-            match = re.match(r'^\d+\.\s*(.*)', line)
-            if match and i < len(text_items):
-                translated = match.group(1).strip()
-                # Clean up any accidentally included quotes
-                translated = translated.strip('"').strip("'")
-                translations[text_items[i]] = translated
+            # Show some examples
+            print(f"  Batch {entry.custom_id}: {len(batch_translations)} items")
+            for orig, trans in list(batch_translations.items())[:3]:
+                print(f"    '{orig}' → '{trans}'")
 
         return translations
 
     except Exception as e:
-        print(f"Error translating batch: {e}")
-        return {}
+        # Keep whatever results were already received
+        print(f"Error running message batch: {e}")
+        return translations
 
 
-def extract_translatable_texts(content):
+def extract_translatable_texts(content, spans):
     """
     Extract all Estonian texts that need translation from the Tableau workbook
-    Returns a dictionary of {pattern_type: [(original, context)]} for batch translation
+    Only texts that can be replaced at one of the spans found by find_replacement_spans are kept
+    Returns a dictionary of {pattern_type: [(original, context)]} for batch translation,
+    plus whether the XML is well-formed and a message, as validate_xml does
+
+    The workbook is streamed once with iterparse and each element is dispatched
+    into its category, instead of scanning the whole content once per pattern.
     """
     texts_to_translate = {
-        'worksheet_names': [],
-        'dashboard_names': [],
-        'captions': [],
-        'aliases': [],
-        'descriptions': [],
-        'members': []
+        'worksheet_names': set(),
+        'dashboard_names': set(),
+        'captions': set(),
+        'aliases': set(),
+        'descriptions': set(),
+        'members': set()
     }
 
-    # Extract worksheet names
-    worksheet_pattern = r"<worksheet name='([^']+)'>"
-    texts_to_translate['worksheet_names'] = list(set(re.findall(worksheet_pattern, content)))
-
-    # Extract dashboard names
-    dashboard_pattern = r"<dashboard name='([^']+)'>"
-    texts_to_translate['dashboard_names'] = list(set(re.findall(dashboard_pattern, content)))
-
-    # Extract captions (avoiding technical field names and those with special chars)
-    caption_pattern = r"caption='([^']+)'"
-    captions = re.findall(caption_pattern, content)
-    # Filter out technical names and those with XML entities
-    texts_to_translate['captions'] = list(set([c for c in captions
-                                                if not re.match(r'^[a-z_]+$', c)
-                                                and '[' not in c
-                                                and not c.startswith('.')
-                                                and '&' not in c]))
-
-    # Extract alias values from <alias> tags
-    alias_pattern = r"<alias key='[^']+' value='([^']+)' />"
-    aliases = re.findall(alias_pattern, content)
-    texts_to_translate['aliases'] = list(set([a for a in aliases if '&' not in a]))
-
-    # Extract member aliases
-    member_pattern = r"<member alias='([^']+)'"
-    members = re.findall(member_pattern, content)
-    texts_to_translate['members'] = list(set([m for m in members if '&' not in m]))
-
-    # Extract text from <run> tags (rich text descriptions) - including those with attributes
-    run_pattern = r"<run[^>]*>([^<]+)</run>"
-    descriptions = re.findall(run_pattern, content)
-    # Filter out very short texts and those with XML entities
-    texts_to_translate['descriptions'] = list(set([d.strip() for d in descriptions
-                                                     if '&' not in d
-                                                     and len(d.strip()) > 0]))
-
-    return texts_to_translate
+    is_valid, message = True, "XML is well-formed"
+    try:
+        for _, elem in ET.iterparse(io.BytesIO(content), events=('end',)):
+            tag = elem.tag
+            attrib = elem.attrib
+
+            # Worksheet and dashboard names
+            if tag == 'worksheet' and 'name' in attrib:
+                texts_to_translate['worksheet_names'].add(attrib['name'])
+            elif tag == 'dashboard' and 'name' in attrib:
+                texts_to_translate['dashboard_names'].add(attrib['name'])
+
+            # Alias values from <alias> tags
+            elif tag == 'alias' and 'key' in attrib and 'value' in attrib:
+                texts_to_translate['aliases'].add(attrib['value'])
+
+            # Text from <run> tags (rich text descriptions)
+            elif tag == 'run' and elem.text and len(elem) == 0:
+                text = elem.text.strip()
+                if text:
+                    texts_to_translate['descriptions'].add(text)
+
+            # Member aliases
+            elif tag == 'member' and 'alias' in attrib:
+                texts_to_translate['members'].add(attrib['alias'])
+
+            # Captions (avoiding technical field names)
+            caption = attrib.get('caption')
+            if (caption
+                    and not TECH_NAME_CHARS.issuperset(caption)
+                    and '[' not in caption
+                    and not caption.startswith('.')):
+                texts_to_translate['captions'].add(caption)
+
+            # Free the element once handled to keep memory bounded
+            elem.clear()
+    except ET.ParseError as e:
+        # Keep the texts found before the error
+        is_valid, message = False, f"XML parse error: {e}"
 
+    # Keep only texts that can be replaced at a span. Texts written with character
+    # references (e.g. "&#10;") never match one, as only the predefined entities are decoded there.
+    replaceable = {original for _, _, original in spans}
+    texts_by_type = {text_type: [t for t in texts
+                                 if t in replaceable
+                                 and not (text_type in AMPERSAND_FILTERED_TYPES and '&' in t)]
+                     for text_type, texts in texts_to_translate.items()}
+    return texts_by_type, is_valid, message
 
-def escape_xml_attr(text):
-    """
-    Escape special characters for XML attributes
-    """
-    # Escape XML special characters
-    text = text.replace('&', '&amp;')  # Must be first
-    text = text.replace('<', '&lt;')
-    text = text.replace('>', '&gt;')
-    text = text.replace("'", '&apos;')
-    text = text.replace('"', '&quot;')
-    return text
 
-
-def safe_replace(content, original, translated):
+def needs_translation(text):
     """
-    Safely replace text in specific XML attribute contexts without breaking entities
+    Cheap pre-filter for texts that are worth sending to Claude
+    Numbers, dates, percentages and short abbreviations (e.g. "TK") are left as they are
     """
-    if not original or not translated or original == translated:
-        return content, 0
+    # Nothing to translate without letters (e.g. "2024", "12.5%", "2024-01-31")
+    if not any(ch.isalpha() for ch in text):
+        return False
 
-    replacements = 0
+    # Short uppercase abbreviations
+    if len(text) <= 3 and text.isascii() and text.isupper():
+        return False
 
-    # Escape special regex characters in original text
-    escaped_original = re.escape(original)
+    return True
 
-    # Escape XML special characters in translated text
-    xml_safe_translated = escape_xml_attr(translated)
 
-    # Replace in specific attribute contexts only
-    # 1. Worksheet/Dashboard name definitions
-    pattern1 = f"(<(?:worksheet|dashboard) name=')({escaped_original})(')"
-    content, count1 = re.subn(pattern1, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count1
+def model_for_context(context):
+    """
+    Choose the model for texts in a context (comma-separated categories)
+    Descriptions need the main model; names, captions, aliases and members are short labels
+    """
+    if 'descriptions' in context.split(','):
+        return MODEL
+    return LABEL_MODEL
 
-    # 1b. Dashboard references (in source elements)
-    pattern1b = f"(dashboard=')({escaped_original})(')"
-    content, count1b = re.subn(pattern1b, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count1b
 
-    # 1c. Worksheet references (in source and other elements)
-    pattern1c = f"(worksheet=')({escaped_original})(')"
-    content, count1c = re.subn(pattern1c, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count1c
+def group_by_context(texts_by_type):
+    """
+    Deduplicate texts across categories so each text is translated only once
+    Returns a dictionary of {context: [text]} where the context lists every category the text appears in
+    """
+    categories_by_text = {}
+    for text_type, items in texts_by_type.items():
+        for text in items:
+            categories_by_text.setdefault(text, []).append(text_type)
 
-    # 1d. Zone name references (worksheets in dashboard zones)
-    pattern1d = f"(<zone[^>]*name=')({escaped_original})(')"
-    content, count1d = re.subn(pattern1d, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count1d
+    texts_by_context = {}
+    for text, categories in categories_by_text.items():
+        texts_by_context.setdefault(",".join(categories), []).append(text)
 
-    # 1e. Action target values (ONLY in param elements with name='target')
-    pattern1e = f"(<param name='target' value=')({escaped_original})(')"
-    content, count1e = re.subn(pattern1e, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count1e
+    return texts_by_context
 
-    # 1f. Window names (for worksheets and dashboards)
-    pattern1f = f"(<window class='(?:worksheet|dashboard)'[^>]*name=')({escaped_original})(')"
-    content, count1f = re.subn(pattern1f, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count1f
 
-    # 1g. Thumbnail names (for worksheets and dashboards)
-    pattern1g = f"(<thumbnail[^>]*name=')({escaped_original})(')"
-    content, count1g = re.subn(pattern1g, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count1g
+def escape_xml_attr(text):
+    """
+    Escape special characters for XML attributes
+    """
+    return text.translate(XML_ESCAPE_TABLE)
 
-    # 1h. Viewpoint names (saved views)
-    pattern1h = f"(<viewpoint[^>]*name=')({escaped_original})(')"
-    content, count1h = re.subn(pattern1h, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count1h
 
-    # 2. Captions
-    pattern2 = f"(caption=')({escaped_original})(')"
-    content, count2 = re.subn(pattern2, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count2
+def unescape_xml(text):
+    """
+    Decode the predefined XML entities; character references (e.g. "&#10;") are left as they are
+    """
+    return XML_ENTITY_PATTERN.sub(lambda match: XML_ENTITIES[match.group(1)], text)
 
-    # 3. Alias values
-    pattern3 = f"(<alias key='[^']+' value=')({escaped_original})(' />)"
-    content, count3 = re.subn(pattern3, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count3
 
-    # 4. Member aliases
-    pattern4 = f"(<member alias=')({escaped_original})(')"
-    content, count4 = re.subn(pattern4, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count4
+def is_replaceable_attribute(tag, name, attributes):
+    """
+    Check whether an attribute holds user-facing text that may be substituted:
+    1. Worksheet/Dashboard name definitions
+    1b-1c. Dashboard and worksheet references (in source and other elements)
+    1d. Zone, thumbnail and viewpoint names
+    1e. Action target values (ONLY in param elements with name='target')
+    1f. Window names (for worksheets and dashboards)
+    2. Captions
+    3. Alias values
+    4. Member aliases
+    """
+    if name in (b'caption', b'dashboard', b'worksheet'):
+        return True
+    if name == b'name':
+        return tag in NAMED_TAGS or (tag == b'window' and attributes.get(b'class') in (b'worksheet', b'dashboard'))
+    if name == b'value':
+        return ((tag == b'param' and attributes.get(b'name') == b'target')
+                or (tag == b'alias' and b'key' in attributes))
+    if name == b'alias':
+        return tag == b'member'
+    return False
+
+
+def find_replacement_spans(content):
+    """
+    Locate every text in a specific XML attribute context that may be replaced
+    Run tags (text content) are included, ignoring leading/trailing whitespace
+    Returns a list of (start, end, original) offsets into content, in document order
+    (original is the text as extract_translatable_texts sees it: predefined XML entities
+    unescaped and whitespace normalised like the XML parser does)
+    """
+    spans = []
+    for match in REPLACE_PATTERN.finditer(content):
+        if match.group('run_value') is not None:
+            # Replace the surrounding whitespace of run text too
+            # Run text is stripped of all (including Unicode) whitespace, as in extraction
+            text = LINE_END_PATTERN.sub('\n', match.group('run_value').decode('utf-8'))
+            original = unescape_xml(text).strip()
+            spans.append((match.end('run_prefix'), match.start('run_suffix'), original))
+            continue
 
-    # 5. Run tags (text content) - including those with attributes
-    pattern5 = f"(<run[^>]*>)({escaped_original})(</run>)"
-    content, count5 = re.subn(pattern5, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count5
+        # Check every attribute of the tag, so several texts in one tag are all found
+        tag = match.group('tag')
+        offset = match.start('attributes')
+        attribute_matches = list(ATTRIBUTE_PATTERN.finditer(match.group('attributes')))
+        attributes = {m.group('name'): m.group('value') for m in attribute_matches}
+        for attribute in attribute_matches:
+            if is_replaceable_attribute(tag, attribute.group('name'), attributes):
+                start, end = attribute.span('value')
+                text = ATTRIBUTE_WHITESPACE_PATTERN.sub(' ', attribute.group('value').decode('utf-8'))
+                original = unescape_xml(text)
+                spans.append((offset + start, offset + end, original))
+    return spans
+
+
+def apply_translations(content, spans, translations, out):
+    """
+    Safely replace text in specific XML attribute contexts without breaking entities
+    The output is written to out in one linear pass over the spans found by find_replacement_spans
+    Returns a Counter of replacements per original text
+    """
+    # Escape and encode each translation once instead of at every occurrence
+    replacements = {original: escape_xml_attr(translated).encode('utf-8')
+                    for original, translated in translations.items()
+                    if translated and translated != original}
+    counts = Counter()
+    position = 0
+
+    for start, end, original in spans:
+        if original not in replacements:
+            continue
 
-    # Also handle run tags with leading/trailing whitespace
-    pattern5b = f"(<run[^>]*>)\\s*({escaped_original})\\s*(</run>)"
-    content, count5b = re.subn(pattern5b, f"\\1{xml_safe_translated}\\3", content)
-    replacements += count5b
+        out.write(content[position:start])
+        out.write(replacements[original])
+        position = end
+        counts[original] += 1
 
-    return content, replacements
+    out.write(content[position:])
+    return counts
 
 
-def translate_file(input_path, output_path, target_language="English"):
+def translate_file(input_path, output_path, target_language="English", use_batch_api=True, use_cache=True):
     """
     Main function to translate the Tableau workbook file
     """
@@ -294,21 +665,29 @@ def translate_file(input_path, output_path, target_language="English"):
     # Create backup
     backup_path = create_backup(input_path)
 
-    # Read the entire file
-    with open(input_path, 'r', encoding='utf-8') as f:
+    # Read the entire workbook XML (unpacking it from a .twbx if needed)
+    # The content is kept as raw bytes; only the extracted texts are decoded
+    with open_workbook_xml(input_path) as f:
         content = f.read()
 
-    # Validate original XML
-    print("\nValidating original XML...")
-    is_valid, message = validate_xml(content)
+    # Extracting the texts parses the whole XML, which also validates the original
+    print("\nExtracting translatable texts and validating original XML...")
+    replacement_spans = find_replacement_spans(content)
+    texts_by_type, is_valid, message = extract_translatable_texts(content, replacement_spans)
     if not is_valid:
         print(f"✗ Warning: Original file has XML issues: {message}")
+        print("  Stopped extracting at the parse error: texts after that position were not")
+        print("  extracted and will stay untranslated.")
         print("  Proceeding anyway, but review the results carefully.")
     else:
         print("✓ Original XML is well-formed")
 
-    print("\nExtracting translatable texts...")
-    texts_by_type = extract_translatable_texts(content)
+    # Skip texts that never need translating before paying for them
+    skipped_items = 0
+    for text_type, items in texts_by_type.items():
+        translatable = [text for text in items if needs_translation(text)]
+        skipped_items += len(items) - len(translatable)
+        texts_by_type[text_type] = translatable
 
     # Show what we found
     total_items = sum(len(items) for items in texts_by_type.values())
@@ -316,42 +695,66 @@ def translate_file(input_path, output_path, target_language="English"):
     for text_type, items in texts_by_type.items():
         if items:
             print(f"  - {text_type}: {len(items)} items")
+    if skipped_items:
+        print(f"  ({skipped_items} numbers, dates and abbreviations skipped)")
+
+    # Translate texts shared by several categories only once
+    texts_by_context = group_by_context(texts_by_type)
+    unique_items = sum(len(items) for items in texts_by_context.values())
+    if unique_items < total_items:
+        print(f"  ({total_items - unique_items} duplicates across categories, {unique_items} texts to send)")
+
+    # Short labels go to the cheaper model, descriptions (rich text) to the main one
+    model_by_text = {text: model_for_context(context)
+                     for context, items in texts_by_context.items() for text in items}
+
+    # Reuse translations from earlier runs
+    cache = open_translation_cache() if use_cache else None
+    cached_translations = {}
+    if cache is not None:
+        for context, items in texts_by_context.items():
+            cached = get_cached_translations(cache, items, target_language, model_for_context(context))
+            cached_translations.update(cached)
+            texts_by_context[context] = [text for text in items if text not in cached]
+        print(f"  ({len(cached_translations)} translations loaded from cache)")
+
+    # Split into batches to avoid token limits
+    batches = []
+    batch_size = 20
+    remaining_items = unique_items - len(cached_translations)
+
+    for context, items in texts_by_context.items():
+        for i in range(0, len(items), batch_size):
+            batches.append((str(len(batches) + 1), items[i:i+batch_size], context, model_for_context(context)))
 
-    # Translate each category
-    all_translations = {}
-    batch_size = 20  # Translate in batches to avoid token limits
-
-    for text_type, items in texts_by_type.items():
-        if not items:
-            continue
-
-        print(f"\nTranslating {text_type} to {target_language}...")
+    # Translate all batches
+    print(f"\nTranslating to {target_language}...")
 
-        # Process in batches
-        for i in range(0, len(items), batch_size):
-            batch = items[i:i+batch_size]
-            print(f"  Batch {i//batch_size + 1}: {len(batch)} items")
+    if use_batch_api and remaining_items >= MIN_BATCH_API_ITEMS:
+        new_translations = asyncio.run(translate_with_batch_api(batches, target_language=target_language))
+    else:
+        # Direct calls return immediately, and small runs aren't worth waiting on a message batch
+        new_translations = asyncio.run(translate_concurrently(batches, target_language=target_language))
 
-            translations = translate_with_claude(batch, target_language=target_language, context=text_type)
-            all_translations.update(translations)
+    if cache is not None:
+        for model in set(model_by_text.values()):
+            store_translations(cache, {text: translated for text, translated in new_translations.items()
+                                       if model_by_text[text] == model}, target_language, model)
+        cache.close()
 
-            # Show some examples
-            for orig, trans in list(translations.items())[:3]:
-                print(f"    '{orig}' → '{trans}'")
+    all_translations = {**cached_translations, **new_translations}
+    translations_by_model = Counter(model_by_text[text] for text in all_translations)
 
     print(f"\nTotal translations: {len(all_translations)}")
 
-    # Apply translations to content
-    print("\nApplying translations...")
-    translated_content = content
-    total_replacements = 0
+    # Apply translations, streaming the result straight to the output file
+    print(f"\nApplying translations and writing translated file: {output_path}")
+    with create_workbook_xml(output_path, input_path) as f:
+        replacement_counts = apply_translations(content, replacement_spans, all_translations, f)
+    total_replacements = sum(replacement_counts.values())
 
-    # Sort by length (longest first) to avoid partial replacements
-    sorted_translations = sorted(all_translations.items(), key=lambda x: len(x[0]), reverse=True)
-
-    for original, translated in sorted_translations:
-        translated_content, count = safe_replace(translated_content, original, translated)
-        total_replacements += count
+    for original in all_translations:
+        count = replacement_counts[original]
         if count > 0:
             print(f"  Replaced '{original}' ({count} occurrences)")
 
@@ -359,20 +762,16 @@ def translate_file(input_path, output_path, target_language="English"):
 
     # Validate translated XML
     print("\nValidating translated XML...")
-    is_valid, message = validate_xml(translated_content)
+    with open_workbook_xml(output_path) as f:
+        is_valid, message = validate_xml(f)
     if not is_valid:
         print(f"✗ ERROR: Translated XML is not well-formed: {message}")
         print(f"  The translation may have introduced errors.")
         print(f"  Backup file preserved at: {backup_path}")
-        print(f"  Attempting to save anyway for inspection...")
+        print(f"  The translated file was saved anyway for inspection.")
     else:
         print("✓ Translated XML is well-formed")
 
-    # Write translated content
-    print(f"\nWriting translated file: {output_path}")
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(translated_content)
-
     print(f"\n{'='*60}")
     print(f"✓ Translation complete!")
     print(f"{'='*60}")
@@ -380,6 +779,8 @@ def translate_file(input_path, output_path, target_language="English"):
     print(f"  Output:       {os.path.basename(output_path)}")
     print(f"  Backup:       {os.path.basename(backup_path)}")
     print(f"  Translations: {len(all_translations)}")
+    for model, count in translations_by_model.items():
+        print(f"    {model}: {count}")
     print(f"  Replacements: {total_replacements}")
     print(f"  XML Valid:    {'Yes' if is_valid else 'No - Check file!'}")
     print(f"{'='*60}")
@@ -388,7 +789,7 @@ def translate_file(input_path, output_path, target_language="English"):
 def main():
     """Main entry point"""
     parser = argparse.ArgumentParser(
-        description='Translate Tableau workbook (.twb) files to any language using Claude API',
+        description='Translate Tableau workbook (.twb/.twbx) files to any language using Claude API',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""
 Examples:
@@ -404,11 +805,15 @@ Examples:
     )
 
     parser.add_argument('input_file', nargs='?', default=INPUT_FILE,
-                        help=f'Input Tableau workbook file (default: {INPUT_FILE})')
+                        help=f'Input Tableau workbook file, .twb or packaged .twbx (default: {INPUT_FILE})')
     parser.add_argument('-l', '--language', default=TARGET_LANGUAGE,
                         help=f'Target language for translation (default: {TARGET_LANGUAGE})')
     parser.add_argument('-o', '--output', default=None,
                         help='Output file path (default: auto-generated based on input file and language)')
+    parser.add_argument('--no-batch-api', action='store_true',
+                        help='Translate with concurrent direct API calls instead of the Message Batches API')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'Do not read or write the translation cache ({CACHE_PATH})')
 
     args = parser.parse_args()
 
@@ -430,8 +835,8 @@ Examples:
     else:
         # Auto-generate output filename based on language
         lang_code = get_language_code(args.language)
-        base_name = os.path.splitext(args.input_file)[0]
-        output_path = os.path.join(script_dir, f"{base_name}_{lang_code}.twb")
+        base_name, extension = os.path.splitext(args.input_file)
+        output_path = os.path.join(script_dir, f"{base_name}_{lang_code}{extension}")
 
     # Validate input file
     if not os.path.exists(input_path):
@@ -448,7 +853,8 @@ Examples:
     print(f"{'='*60}\n")
 
     try:
-        translate_file(input_path, output_path, target_language=args.language)
+        translate_file(input_path, output_path, target_language=args.language,
+                       use_batch_api=not args.no_batch_api, use_cache=not args.no_cache)
     except Exception as e:
         print(f"\n{'='*60}")
         print(f"Error during translation: {e}")